@@ -0,0 +1,120 @@
+"""Compare storage and index footprint of the plain and compact document formats.
+
+Generates synthetic queue entries and hygiene ratings, writes each set into
+scratch collections in both formats with the indexes the API creates, and prints
+document, storage and index sizes from collStats. The scratch collections are
+dropped afterwards.
+
+    python benchmark_storage.py
+    python benchmark_storage.py --count 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import bson
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from storage import COLOR_CODES, PRIORITY_CODES, hygiene_rating_storage, queue_storage
+
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+BATCH_SIZE = 1000
+
+
+def queue_document(now: datetime, version: int):
+    created_at = now - timedelta(minutes=random.randint(10, 500000))
+    started_at = created_at + timedelta(minutes=random.randint(0, 30))
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": str(uuid.uuid4()),
+        "user_name": random.choice(["Alice", "Bob", "Charlie", "Dana"]),
+        "user_color": random.choice(list(COLOR_CODES)),
+        "priority": random.choice(list(PRIORITY_CODES)),
+        "status": "completed",
+        "reason": random.choice([None, "Quick break", "Shower"]),
+        "created_at": created_at,
+        "started_at": started_at,
+        "completed_at": started_at + timedelta(minutes=random.randint(2, 20)),
+        "schedule_keys": {"strict": 1e10 + version, "aging": 600.0 + version, "fair": version / 6},
+        "version": version,
+    }
+
+
+def rating_document(now: datetime, version: int):
+    return {
+        "id": str(uuid.uuid4()),
+        "rated_by_user_id": str(uuid.uuid4()),
+        "rated_by_name": random.choice(["Alice", "Bob", "Charlie", "Dana"]),
+        "rating": random.randint(1, 5),
+        "comment": random.choice([None, "Spotless", "Needs a clean"]),
+        "created_at": now - timedelta(minutes=random.randint(10, 500000)),
+        "version": version,
+    }
+
+
+async def measure(db, name, documents, codec, indexes):
+    collection = db[name]
+    await collection.drop()
+    # Copy, since insert_many adds an _id to the documents it is given
+    encoded = [dict(codec.encode(doc)) for doc in documents]
+    for start in range(0, len(encoded), BATCH_SIZE):
+        await collection.insert_many(encoded[start:start + BATCH_SIZE])
+    for keys in indexes:
+        await collection.create_index([(codec.field(field), 1) for field in keys])
+    stats = await db.command("collStats", name)
+    await collection.drop()
+    return {
+        "bson_bytes": sum(len(bson.encode(doc)) for doc in encoded) / len(encoded),
+        "size": stats["size"],
+        "storage": stats["storageSize"],
+        "indexes": stats["totalIndexSize"],
+    }
+
+
+async def main(count: int):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    now = datetime.utcnow()
+    datasets = [
+        (
+            "queue",
+            [queue_document(now, version) for version in range(count)],
+            queue_storage,
+            [["version"], ["status", "schedule_keys.strict"], ["status", "schedule_keys.aging"],
+             ["status", "schedule_keys.fair"]],
+        ),
+        (
+            "hygiene_ratings",
+            [rating_document(now, version) for version in range(count)],
+            hygiene_rating_storage,
+            [["version"], ["created_at"]],
+        ),
+    ]
+
+    print(f"{'collection':<16} {'format':<8} {'avg bson':>9} {'data':>12} {'storage':>12} {'indexes':>12}")
+    try:
+        for name, documents, storage, indexes in datasets:
+            for compact in (False, True):
+                label = "compact" if compact else "plain"
+                stats = await measure(db, f"benchmark_{name}_{label}", documents, storage(compact), indexes)
+                print(
+                    f"{name:<16} {label:<8} {stats['bson_bytes']:>9.1f} {stats['size']:>12,} "
+                    f"{stats['storage']:>12,} {stats['indexes']:>12,}"
+                )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000, help="Documents per collection")
+    args = parser.parse_args()
+    asyncio.run(main(args.count))
@@ -0,0 +1,56 @@
+"""Version stamping for the delta-sync feed.
+
+Every write takes a version from a single monotonically increasing counter.
+Versions are handed out before the write lands, so a later version can commit
+before an earlier one. The feed therefore only reports a version once every
+write that might still get an earlier one has finished. Each write registers
+an in-flight marker before taking its version. The marker holds the counter
+value seen just before, and readers never report past the lowest such value.
+"""
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+
+class ChangeTracker:
+    def __init__(self, counters, in_flight, stale_after: float = 30):
+        self.counters = counters
+        self.in_flight = in_flight
+        # Markers left behind by a crashed writer stop holding the feed back after this
+        self.stale_after = stale_after
+
+    async def create_indexes(self):
+        await self.in_flight.create_index("floor")
+        await self.in_flight.create_index("at", expireAfterSeconds=int(self.stale_after * 2))
+
+    async def latest_version(self) -> int:
+        counter = await self.counters.find_one({"_id": "changes"})
+        return counter["seq"] if counter else 0
+
+    @asynccontextmanager
+    async def write(self):
+        # Register before taking a version: a reader that has not seen this marker
+        # yet read the counter before our increment, so it cannot report our version
+        marker = {"_id": uuid.uuid4().hex, "floor": await self.latest_version(), "at": datetime.utcnow()}
+        await self.in_flight.insert_one(marker)
+        try:
+            counter = await self.counters.find_one_and_update(
+                {"_id": "changes"},
+                {"$inc": {"seq": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            yield counter["seq"]
+        finally:
+            await self.in_flight.delete_one({"_id": marker["_id"]})
+
+    async def committed_version(self) -> int:
+        # The counter has to be read before the markers, never after
+        version = await self.latest_version()
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        oldest = await self.in_flight.find({"at": {"$gt": cutoff}}).sort("floor", 1).limit(1).to_list(1)
+        if oldest:
+            version = min(version, oldest[0]["floor"])
+        return version
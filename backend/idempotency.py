@@ -0,0 +1,161 @@
+"""Idempotency-Key support for write endpoints.
+
+The first response for a key is kept in a small in-memory LRU and in a MongoDB
+collection with a TTL index. Retries with the same key get that response back
+without running the handler again. Duplicates that arrive while the first request
+is still running wait for it instead of starting a second one.
+
+Before the handler runs, a pending record claims the key through the unique index,
+so this also holds across processes. A duplicate that loses the claim polls the
+stored record until the response lands, and gives up with a 409 if it takes too
+long. If the handler fails, the claim is released so a retry can run it again.
+A claim is also a lease: once it is older than `lease_seconds` without a response,
+its owner is presumed dead and a retry of the same request takes it over.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import time
+from collections import OrderedDict
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import DuplicateKeyError
+
+
+class IdempotencyCache:
+    def __init__(self, collection, ttl_seconds: float = 86400, max_entries: int = 1024,
+                 wait_timeout: float = 10, poll_interval: float = 0.05, lease_seconds: float = 30):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._recent: OrderedDict = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def create_indexes(self):
+        await self.collection.create_index("key", unique=True)
+        await self.collection.create_index("created_at", expireAfterSeconds=int(self.ttl_seconds))
+
+    def _remember(self, key: str, record: Dict):
+        self._recent[key] = {**record, "stored_at": time.monotonic()}
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+
+    def _recall(self, key: str) -> Optional[Dict]:
+        record = self._recent.get(key)
+        if record is None:
+            return None
+        if time.monotonic() - record["stored_at"] > self.ttl_seconds:
+            del self._recent[key]
+            return None
+        self._recent.move_to_end(key)
+        return record
+
+    async def _claim(self, key: str, fingerprint: str, claim: str) -> Optional[Dict]:
+        # Returns None once this request owns the key, otherwise the record to replay
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = datetime.utcnow()
+            try:
+                await self.collection.insert_one(
+                    {"key": key, "fingerprint": fingerprint, "claim": claim, "claimed_at": now, "created_at": now}
+                )
+                return None
+            except DuplicateKeyError:
+                pass
+            record = await self.collection.find_one({"key": key}, {"_id": 0})
+            # A different request fails straight away; the same one waits for its response
+            if record is not None and ("response" in record or record["fingerprint"] != fingerprint):
+                return record
+            # No record means the owner failed and released the key, so try to claim it again
+            if record is None:
+                continue
+            taken_over = await self.collection.find_one_and_update(
+                {
+                    "key": key,
+                    "fingerprint": fingerprint,
+                    "response": {"$exists": False},
+                    "claimed_at": {"$lt": now - timedelta(seconds=self.lease_seconds)},
+                },
+                {"$set": {"claim": claim, "claimed_at": now}}
+            )
+            if taken_over is not None:
+                return None
+            if time.monotonic() > deadline:
+                raise HTTPException(
+                    status_code=409, detail="A request with this idempotency key is still in progress"
+                )
+            await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, key: str, fingerprint: str, claim: str, handler, kwargs: Dict) -> Dict:
+        # Both writes are tied to our claim so they never touch a claim taken over after our lease ran out
+        try:
+            response = jsonable_encoder(await handler(**kwargs))
+        except BaseException:
+            await self.collection.delete_one({"key": key, "claim": claim, "response": {"$exists": False}})
+            raise
+        await self.collection.update_one({"key": key, "claim": claim}, {"$set": {"response": response}})
+        return {"fingerprint": fingerprint, "response": response}
+
+    @staticmethod
+    def fingerprint(request: Dict) -> str:
+        return hashlib.sha256(json.dumps(jsonable_encoder(request), sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _replay(record: Dict, fingerprint: str):
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency key reused with a different request")
+        return record["response"]
+
+    def idempotent(self, handler):
+        # The handler must take an `idempotency_key` header parameter; requests
+        # without one run as usual
+        @functools.wraps(handler)
+        async def wrapper(**kwargs):
+            idempotency_key = kwargs.get("idempotency_key")
+            if not idempotency_key:
+                return await handler(**kwargs)
+
+            key = f"{handler.__name__}:{idempotency_key}"
+            fingerprint = self.fingerprint(
+                {name: value for name, value in kwargs.items() if name != "idempotency_key"}
+            )
+
+            while True:
+                record = self._recall(key)
+                if record is not None:
+                    return self._replay(record, fingerprint)
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    break
+                # None means the leader failed or was cancelled and gave the key up
+                record = await asyncio.shield(in_flight)
+                if record is not None:
+                    return self._replay(record, fingerprint)
+
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[key] = future
+            record = None
+            try:
+                claim = uuid.uuid4().hex
+                record = await self._claim(key, fingerprint, claim)
+                if record is None:
+                    record = await self._run(key, fingerprint, claim, handler, kwargs)
+                if "response" in record:
+                    self._remember(key, record)
+            finally:
+                del self._in_flight[key]
+                # Waiters never inherit our failure or cancellation; they go back and claim the key
+                future.set_result(record)
+
+            return self._replay(record, fingerprint)
+
+        return wrapper
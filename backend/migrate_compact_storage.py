@@ -0,0 +1,69 @@
+"""Convert queue and hygiene rating documents to or from the compact storage format.
+
+Run this before switching COMPACT_STORAGE on (or with --reverse before switching it
+off), with the API stopped. Documents already in the target format are skipped.
+Secondary indexes on the converted collections are dropped; the API recreates them
+under the new field names when it next starts.
+
+    python migrate_compact_storage.py
+    python migrate_compact_storage.py --reverse
+"""
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from storage import hygiene_rating_storage, queue_storage
+
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+COLLECTIONS = {
+    "queue": queue_storage(True),
+    "hygiene_ratings": hygiene_rating_storage(True),
+}
+
+
+async def migrate_collection(collection, codec, reverse: bool) -> int:
+    converted = 0
+    # Documents in the plain format always carry the string `id` field
+    pending = {"id": {"$exists": not reverse}}
+    async for doc in collection.find(pending):
+        if reverse:
+            target = codec.decode(doc)
+            target.pop("_id", None)
+        else:
+            plain = {name: value for name, value in doc.items() if name != "_id"}
+            target = codec.encode(plain)
+        # The _id changes between formats, so write the new document before dropping
+        # the old one; upserting keeps a rerun after an interruption safe
+        if reverse:
+            await collection.replace_one({"id": target["id"]}, target, upsert=True)
+        else:
+            await collection.replace_one({"_id": target["_id"]}, target, upsert=True)
+        await collection.delete_one({"_id": doc["_id"]})
+        converted += 1
+    return converted
+
+
+async def main(reverse: bool):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        for name, codec in COLLECTIONS.items():
+            converted = await migrate_collection(db[name], codec, reverse)
+            await db[name].drop_indexes()
+            print(f"{name}: converted {converted} documents")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reverse", action="store_true", help="Convert compact documents back to the plain format")
+    args = parser.parse_args()
+    asyncio.run(main(args.reverse))
@@ -0,0 +1,254 @@
+"""Lightweight request profiling.
+
+Every request gets a timing, a per-route aggregate and a list of the MongoDB
+commands it issued (via pymongo command monitoring). Requests that run longer
+than the slow threshold also get a snapshot of the async stack they were stuck
+in. A small random sample (or any request sent with an `X-Profile` header) is
+run under cProfile as well. The event loop is polled in the background for lag.
+"""
+import asyncio
+import cProfile
+import hmac
+import pstats
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import monitoring
+
+
+MAX_MONGO_CALLS = 50
+MAX_STACK_FRAMES = 40
+TOP_FUNCTIONS = 25
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.mongo_calls: List[Dict] = []
+        self.mongo_count = 0
+        self.mongo_total_ms = 0.0
+        self.stack: Optional[List[str]] = None
+        self.pending_commands: Dict[int, Optional[str]] = {}
+
+    def capture_stack(self, task: asyncio.Task):
+        self.stack = async_stack(task)
+
+    def to_dict(self) -> Dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "mongo_count": self.mongo_count,
+            "mongo_total_ms": round(self.mongo_total_ms, 3),
+            "mongo_calls": self.mongo_calls,
+            "stack": self.stack,
+        }
+
+
+def async_stack(task: asyncio.Task) -> List[str]:
+    # Task.get_stack() only shows the outermost frame of a suspended task, so
+    # follow the await chain down to whatever it is actually waiting on
+    frames = []
+    coro = task.get_coro()
+    while coro is not None and len(frames) < MAX_STACK_FRAMES:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    # Motor runs pymongo on a thread pool but copies the caller's context, so
+    # these callbacks see the profile of the request that issued the command
+
+    def started(self, event):
+        profile = current_profile.get()
+        if profile is not None:
+            target = event.command.get(event.command_name)
+            profile.pending_commands[event.request_id] = target if isinstance(target, str) else None
+
+    def succeeded(self, event):
+        self._finish(event, True)
+
+    def failed(self, event):
+        self._finish(event, False)
+
+    def _finish(self, event, ok: bool):
+        profile = current_profile.get()
+        if profile is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        collection = profile.pending_commands.pop(event.request_id, None)
+        profile.mongo_count += 1
+        profile.mongo_total_ms += duration_ms
+        if len(profile.mongo_calls) < MAX_MONGO_CALLS:
+            profile.mongo_calls.append({
+                "command": event.command_name,
+                "collection": collection,
+                "duration_ms": round(duration_ms, 3),
+                "ok": ok,
+            })
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.5, history: int = 240):
+        self.interval = interval
+        self.lags_ms = deque(maxlen=history)
+        self.max_lag_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, loop.time() - started - self.interval) * 1000
+            self.lags_ms.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def snapshot(self) -> Dict:
+        recent = sorted(self.lags_ms)
+        return {
+            "interval_ms": self.interval * 1000,
+            "current_ms": round(self.lags_ms[-1], 3) if self.lags_ms else None,
+            "p99_ms": round(recent[int(0.99 * (len(recent) - 1))], 3) if recent else None,
+            "max_ms": round(self.max_lag_ms, 3),
+        }
+
+
+class Profiler:
+    def __init__(self, enabled: bool = True, sample_rate: float = 0.01,
+                 slow_threshold_ms: float = 1000, history: int = 50):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_requests = deque(maxlen=history)
+        self.sampled_requests = deque(maxlen=history)
+        self.routes: Dict[str, Dict] = {}
+        self.loop_lag = LoopLagMonitor()
+        self._sampling = False
+
+    def start_sampling(self, forced: bool) -> Optional[cProfile.Profile]:
+        # cProfile sees the whole event loop thread, so one sample at a time
+        if self._sampling or not (forced or random.random() < self.sample_rate):
+            return None
+        self._sampling = True
+        sampler = cProfile.Profile()
+        sampler.enable()
+        return sampler
+
+    def stop_sampling(self, sampler: cProfile.Profile) -> List[Dict]:
+        sampler.disable()
+        self._sampling = False
+        stats = pstats.Stats(sampler).stats
+        top = sorted(stats.items(), key=lambda entry: entry[1][3], reverse=True)[:TOP_FUNCTIONS]
+        return [
+            {
+                "function": f"{name} ({filename}:{line})",
+                "calls": calls,
+                "own_ms": round(own * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in top
+        ]
+
+    def record(self, route: str, profile: RequestProfile, duration_ms: float, functions: Optional[List[Dict]]):
+        stats = self.routes.setdefault(route, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += duration_ms
+        stats["max_ms"] = max(stats["max_ms"], duration_ms)
+
+        if duration_ms < self.slow_threshold_ms and functions is None:
+            return
+        entry = {**profile.to_dict(), "route": route, "duration_ms": round(duration_ms, 3)}
+        if duration_ms >= self.slow_threshold_ms:
+            self.slow_requests.append(entry)
+        if functions is not None:
+            self.sampled_requests.append({**entry, "functions": functions})
+
+    def settings(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "slow_threshold_ms": self.slow_threshold_ms,
+        }
+
+    def snapshot(self) -> Dict:
+        return {
+            "settings": self.settings(),
+            "loop_lag": self.loop_lag.snapshot(),
+            "routes": {
+                route: {
+                    "count": stats["count"],
+                    "mean_ms": round(stats["total_ms"] / stats["count"], 3),
+                    "max_ms": round(stats["max_ms"], 3),
+                }
+                for route, stats in self.routes.items()
+            },
+            "slow_requests": list(self.slow_requests),
+            "sampled_requests": list(self.sampled_requests),
+        }
+
+
+def admin_token_matches(admin_token: Optional[str], provided: Optional[str]) -> bool:
+    # Without a configured token nobody is an admin
+    if not admin_token or provided is None:
+        return False
+    return hmac.compare_digest(admin_token.encode(), provided.encode())
+
+
+class ProfilingMiddleware:
+    # Plain ASGI middleware so the endpoint runs in this task and its stack can
+    # be captured while it is still in flight
+
+    def __init__(self, app, profiler: Profiler, admin_token: Optional[str] = None):
+        self.app = app
+        self.profiler = profiler
+        self.admin_token = admin_token
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+        headers = dict(scope.get("headers", []))
+        # Forcing a profile is costly, so only admins may ask for one
+        forced = b"x-profile" in headers and admin_token_matches(
+            self.admin_token, headers.get(b"x-admin-token", b"").decode("latin-1")
+        )
+        sampler = self.profiler.start_sampling(forced)
+        watchdog = asyncio.get_running_loop().call_later(
+            self.profiler.slow_threshold_ms / 1000, profile.capture_stack, asyncio.current_task()
+        )
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            watchdog.cancel()
+            functions = self.profiler.stop_sampling(sampler) if sampler else None
+            current_profile.reset(token)
+            endpoint = scope.get("endpoint")
+            route = endpoint.__name__ if endpoint else "unmatched"
+            self.profiler.record(route, profile, duration_ms, functions)
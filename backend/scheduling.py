@@ -0,0 +1,118 @@
+"""Queue scheduling policies.
+
+Each policy hands out a sort key once, when an entry joins the queue, and the
+waiting queue is simply ordered by that key (lowest first). Keys never need to
+be recomputed as time passes, so ordering can be kept incrementally: a heap in
+memory, or an index on the stored key in MongoDB.
+"""
+import heapq
+import itertools
+from typing import Dict, Optional
+
+
+# Emergency gets highest priority (1), Work (2), Health (3)
+PRIORITY_RANK = {"emergency": 1, "work": 2, "health": 3}
+
+# Wider than any epoch timestamp we will see, so rank always dominates arrival time
+RANK_SPAN = 1e10
+
+
+class SchedulingPolicy:
+    name = ""
+
+    def admit(self, priority: str, arrived_at: float) -> float:
+        raise NotImplementedError
+
+    def dispatched(self, key: float):
+        pass
+
+    def withdrawn(self, priority: str, key: float):
+        # Called for an entry that left the queue without being served
+        pass
+
+    def state(self) -> Dict:
+        return {}
+
+    def load_state(self, state: Dict):
+        pass
+
+
+class StrictPriorityPolicy(SchedulingPolicy):
+    """Emergency > work > health, first come first served within a level."""
+    name = "strict"
+
+    def admit(self, priority: str, arrived_at: float) -> float:
+        return PRIORITY_RANK[priority] * RANK_SPAN + arrived_at
+
+
+class AgingPolicy(SchedulingPolicy):
+    """Priority boost of one level for every `aging_seconds` spent waiting.
+
+    An entry's effective rank is `rank - waited / aging_seconds`. Every entry ages
+    at the same rate, so comparing effective ranks is the same as comparing
+    `rank * aging_seconds + arrived_at`, which is fixed at admission.
+    """
+    name = "aging"
+
+    def __init__(self, aging_seconds: float = 600):
+        self.aging_seconds = aging_seconds
+
+    def admit(self, priority: str, arrived_at: float) -> float:
+        return PRIORITY_RANK[priority] * self.aging_seconds + arrived_at
+
+
+class WeightedFairPolicy(SchedulingPolicy):
+    """Self-clocked weighted fair queueing across priority levels.
+
+    Every session counts as one unit of service. Each level gets a share of turns
+    proportional to its weight while it has entries waiting.
+    """
+    name = "fair"
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = weights or {"emergency": 6, "work": 3, "health": 1}
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+
+    def admit(self, priority: str, arrived_at: float) -> float:
+        start = max(self.virtual_time, self.last_finish.get(priority, 0.0))
+        finish = start + 1.0 / self.weights[priority]
+        self.last_finish[priority] = finish
+        return finish
+
+    def dispatched(self, key: float):
+        self.virtual_time = max(self.virtual_time, key)
+
+    def withdrawn(self, priority: str, key: float):
+        # Hand the slot back if nothing has queued behind it, otherwise an entry
+        # that joins and leaves would push every later one at its level back
+        if self.last_finish.get(priority) == key:
+            self.last_finish[priority] = key - 1.0 / self.weights[priority]
+
+    def state(self) -> Dict:
+        return {"virtual_time": self.virtual_time, "last_finish": dict(self.last_finish)}
+
+    def load_state(self, state: Dict):
+        self.virtual_time = state.get("virtual_time", 0.0)
+        self.last_finish = dict(state.get("last_finish", {}))
+
+
+class PolicyQueue:
+    """In-memory waiting queue ordered by a policy, O(log n) per join and dispatch."""
+
+    def __init__(self, policy: SchedulingPolicy):
+        self.policy = policy
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, priority: str, arrived_at: float):
+        key = self.policy.admit(priority, arrived_at)
+        heapq.heappush(self._heap, (key, next(self._counter), item))
+
+    def pop(self):
+        key, _, item = heapq.heappop(self._heap)
+        self.policy.dispatched(key)
+        return item
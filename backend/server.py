@@ -1,15 +1,26 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
+import csv
+import io
+import json
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+from scheduling import AgingPolicy, StrictPriorityPolicy, WeightedFairPolicy
+from profiling import MongoCommandTimer, Profiler, ProfilingMiddleware, admin_token_matches
+from idempotency import IdempotencyCache
+from changes import ChangeTracker
+from storage import DocumentCodec, hygiene_rating_storage, queue_storage
 
 
 ROOT_DIR = Path(__file__).parent
@@ -17,9 +28,52 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandTimer()])
 db = client[os.environ['DB_NAME']]
 
+# Optional compact document encoding for the queue and hygiene ratings. Existing
+# data has to be converted with migrate_compact_storage.py before turning it on.
+compact_storage = os.environ.get('COMPACT_STORAGE', 'false').lower() == 'true'
+queue_codec = queue_storage(compact_storage)
+rating_codec = hygiene_rating_storage(compact_storage)
+storage_codecs = {"queue": queue_codec, "hygiene_ratings": rating_codec}
+plain_codec = DocumentCodec(compact=False)
+
+# Version stamps for the delta-sync feed. Deletion tombstones are pruned after the
+# retention window; clients that last synced before that have to resync from scratch.
+changes = ChangeTracker(db.counters, db.changes_in_flight)
+deletion_retention = timedelta(days=float(os.environ.get('DELETION_RETENTION_DAYS', 30)))
+
+# Responses to write requests carrying an Idempotency-Key, replayed on retries
+idempotency = IdempotencyCache(
+    db.idempotency_keys,
+    ttl_seconds=float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400)),
+)
+
+# Queue scheduling policies, keyed by name. Strict priority is the default ordering.
+scheduling_policies = {
+    policy.name: policy
+    for policy in [
+        StrictPriorityPolicy(),
+        AgingPolicy(float(os.environ.get('QUEUE_AGING_SECONDS', 600))),
+        WeightedFairPolicy(),
+    ]
+}
+default_queue_policy = os.environ.get('QUEUE_POLICY', StrictPriorityPolicy.name)
+if default_queue_policy not in scheduling_policies:
+    raise RuntimeError(
+        f"QUEUE_POLICY must be one of {', '.join(scheduling_policies)}, got {default_queue_policy!r}"
+    )
+
+# Request profiling, cheap enough to leave on with a low sample rate
+profiler = Profiler(
+    enabled=os.environ.get('PROFILING_ENABLED', 'true').lower() == 'true',
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01)),
+    slow_threshold_ms=float(os.environ.get('SLOW_REQUEST_MS', 1000)),
+)
+# Admin endpoints stay closed until a token is configured
+admin_token = os.environ.get('ADMIN_TOKEN')
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -48,6 +102,10 @@ class UserColor(str, Enum):
     PINK = "pink"
     CYAN = "cyan"
 
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
 
 # Models
 class User(BaseModel):
@@ -98,6 +156,10 @@ class UtilityItem(BaseModel):
     last_bought_date: datetime
     next_buyer_user_id: Optional[str] = None
     next_buyer_name: Optional[str] = None
+    purchase_count: int = 1
+    purchase_counts: Dict[str, int] = {}
+    average_interval_hours: Optional[float] = None
+    predicted_restock_date: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class UtilityItemCreate(BaseModel):
@@ -105,22 +167,129 @@ class UtilityItemCreate(BaseModel):
     last_bought_by_user_id: str
     next_buyer_user_id: Optional[str] = None
 
+class UtilityPurchase(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    utility_id: str
+    bought_by_user_id: str
+    bought_by_name: str
+    bought_at: datetime = Field(default_factory=datetime.utcnow)
+
+class UtilityPurchaseCreate(BaseModel):
+    bought_by_user_id: str
+
+class ChangesFeed(BaseModel):
+    version: int
+    users: List[User] = []
+    queue: List[QueueItem] = []
+    hygiene_ratings: List[HygieneRating] = []
+    utilities: List[UtilityItem] = []
+    deleted: Dict[str, List[str]] = {}
+    has_more: bool = False
+
+class ProfilingSettingsUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    slow_threshold_ms: Optional[float] = Field(None, gt=0)
+
 class BathroomState(BaseModel):
     is_occupied: bool = False
     current_user: Optional[Dict] = None
     last_hygiene_rating: Optional[HygieneRating] = None
 
 
+# Change tracking
+# Every write stamps the document with a version from `changes.write()`, and deletes
+# leave a tombstone behind, so clients can ask for just what changed since the last
+# version they saw.
+SYNCED_COLLECTIONS = {
+    "users": User,
+    "queue": QueueItem,
+    "hygiene_ratings": HygieneRating,
+    "utilities": UtilityItem,
+}
+
+async def record_deletion(collection: str, doc_id: str):
+    async with changes.write() as version:
+        await db.deletions.insert_one({
+            "collection": collection,
+            "id": doc_id,
+            "version": version,
+            "deleted_at": datetime.utcnow()
+        })
+
+async def prune_deletions():
+    cutoff = datetime.utcnow() - deletion_retention
+    newest = await db.deletions.find({"deleted_at": {"$lt": cutoff}}).sort("version", -1).to_list(1)
+    if not newest:
+        return
+    # Remember how far tombstones are gone before removing them, so a client can
+    # never be served a feed with deletions silently missing
+    pruned_through = newest[0]["version"]
+    await db.counters.update_one(
+        {"_id": "deletions"},
+        {"$max": {"pruned_through": pruned_through}},
+        upsert=True
+    )
+    await db.deletions.delete_many({"version": {"$lte": pruned_through}})
+
+async def prune_deletions_periodically(interval_seconds: float = 3600):
+    while True:
+        try:
+            await prune_deletions()
+        except Exception:
+            logger.exception("Pruning deletion tombstones failed")
+        await asyncio.sleep(interval_seconds)
+
+
+# Queue scheduling
+# Each queue entry gets one sort key per policy when it joins, so the waiting
+# queue can be read back in order straight off an index.
+def epoch_seconds(value: datetime) -> float:
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+async def save_scheduling_state():
+    await db.counters.update_one(
+        {"_id": "scheduling"},
+        {"$set": {name: policy.state() for name, policy in scheduling_policies.items()}},
+        upsert=True
+    )
+
+async def admit_to_schedule(priority: str, created_at: datetime,
+                            names: Optional[List[str]] = None) -> Dict[str, float]:
+    arrived_at = epoch_seconds(created_at)
+    keys = {
+        name: policy.admit(priority, arrived_at)
+        for name, policy in scheduling_policies.items()
+        if names is None or name in names
+    }
+    await save_scheduling_state()
+    return keys
+
+async def dispatch_from_schedule(keys: Dict[str, float]):
+    for name, key in keys.items():
+        if name in scheduling_policies:
+            scheduling_policies[name].dispatched(key)
+    await save_scheduling_state()
+
+async def withdraw_from_schedule(priority: str, keys: Dict[str, float]):
+    for name, key in keys.items():
+        if name in scheduling_policies:
+            scheduling_policies[name].withdrawn(priority, key)
+    await save_scheduling_state()
+
+
 # User Management Routes
 @api_router.post("/users", response_model=User)
-async def create_user(user_data: UserCreate):
+@idempotency.idempotent
+async def create_user(user_data: UserCreate, idempotency_key: Optional[str] = Header(None)):
     # Check if color is already taken
     existing_user = await db.users.find_one({"color": user_data.color})
     if existing_user:
         raise HTTPException(status_code=400, detail="Color already taken by another user")
     
     user = User(**user_data.dict())
-    await db.users.insert_one(user.dict())
+    async with changes.write() as version:
+        await db.users.insert_one({**user.dict(), "version": version})
     return user
 
 @api_router.get("/users", response_model=List[User])
@@ -133,22 +302,24 @@ async def delete_user(user_id: str):
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await record_deletion("users", user_id)
     return {"message": "User deleted successfully"}
 
 
 # Queue Management Routes  
 @api_router.post("/queue", response_model=QueueItem)
-async def join_queue(queue_data: QueueItemCreate):
+@idempotency.idempotent
+async def join_queue(queue_data: QueueItemCreate, idempotency_key: Optional[str] = Header(None)):
     # Get user info
     user = await db.users.find_one({"id": queue_data.user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Check if user is already in queue
-    existing_queue_item = await db.queue.find_one({
+    existing_queue_item = await db.queue.find_one(queue_codec.query({
         "user_id": queue_data.user_id, 
         "status": {"$in": ["waiting", "using"]}
-    })
+    }))
     if existing_queue_item:
         raise HTTPException(status_code=400, detail="User already in queue")
     
@@ -161,61 +332,73 @@ async def join_queue(queue_data: QueueItemCreate):
         reason=queue_data.reason
     )
     
-    await db.queue.insert_one(queue_item.dict())
+    schedule_keys = await admit_to_schedule(queue_item.priority.value, queue_item.created_at)
+    async with changes.write() as version:
+        await db.queue.insert_one(queue_codec.encode({
+            **queue_item.dict(),
+            "schedule_keys": schedule_keys,
+            "version": version
+        }))
     return queue_item
 
 @api_router.get("/queue", response_model=List[QueueItem])
-async def get_queue():
-    # Priority order: Emergency -> Work -> Health
-    # Emergency gets highest priority (1), Work (2), Health (3)
-    priority_order = {"emergency": 1, "work": 2, "health": 3}
-    
-    queue_items = await db.queue.find({"status": "waiting"}).to_list(100)
+async def get_queue(policy: Optional[str] = None):
+    policy = policy or default_queue_policy
+    if policy not in scheduling_policies:
+        raise HTTPException(status_code=400, detail="Unknown scheduling policy")
     
-    # Sort by priority first, then by created_at
-    sorted_queue = sorted(queue_items, key=lambda x: (priority_order[x["priority"]], x["created_at"]))
+    # Keys were fixed when each entry joined, so the index gives us the order
+    queue_items = await db.queue.find(
+        queue_codec.query({"status": "waiting"})
+    ).sort(queue_codec.field(f"schedule_keys.{policy}"), 1).to_list(100)
     
-    return [QueueItem(**item) for item in sorted_queue]
+    return [QueueItem(**queue_codec.decode(item)) for item in queue_items]
 
 @api_router.get("/queue/current", response_model=Optional[QueueItem])
 async def get_current_user():
-    current = await db.queue.find_one({"status": "using"})
-    return QueueItem(**current) if current else None
+    current = await db.queue.find_one(queue_codec.query({"status": "using"}))
+    return QueueItem(**queue_codec.decode(current)) if current else None
 
 @api_router.post("/queue/{queue_item_id}/start")
 async def start_using_bathroom(queue_item_id: str):
     # Check if bathroom is already occupied
-    current_user = await db.queue.find_one({"status": "using"})
+    current_user = await db.queue.find_one(queue_codec.query({"status": "using"}))
     if current_user:
         raise HTTPException(status_code=400, detail="Bathroom is already occupied")
     
     # Update queue item to using status
-    result = await db.queue.update_one(
-        {"id": queue_item_id, "status": "waiting"},
-        {
-            "$set": {
-                "status": "using",
-                "started_at": datetime.utcnow()
-            }
-        }
-    )
+    async with changes.write() as version:
+        started = await db.queue.find_one_and_update(
+            queue_codec.query({"id": queue_item_id, "status": "waiting"}),
+            queue_codec.update({
+                "$set": {
+                    "status": "using",
+                    "started_at": datetime.utcnow(),
+                    "version": version
+                }
+            }),
+            projection=queue_codec.projection({"schedule_keys": 1})
+        )
     
-    if result.modified_count == 0:
+    if started is None:
         raise HTTPException(status_code=404, detail="Queue item not found or not in waiting status")
     
+    await dispatch_from_schedule(queue_codec.decode(started).get("schedule_keys", {}))
     return {"message": "Started using bathroom"}
 
 @api_router.post("/queue/{queue_item_id}/complete")
 async def complete_bathroom_use(queue_item_id: str):
-    result = await db.queue.update_one(
-        {"id": queue_item_id, "status": "using"},
-        {
-            "$set": {
-                "status": "completed",
-                "completed_at": datetime.utcnow()
-            }
-        }
-    )
+    async with changes.write() as version:
+        result = await db.queue.update_one(
+            queue_codec.query({"id": queue_item_id, "status": "using"}),
+            queue_codec.update({
+                "$set": {
+                    "status": "completed",
+                    "completed_at": datetime.utcnow(),
+                    "version": version
+                }
+            })
+        )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Queue item not found or not in using status")
@@ -224,15 +407,21 @@ async def complete_bathroom_use(queue_item_id: str):
 
 @api_router.delete("/queue/{queue_item_id}")
 async def remove_from_queue(queue_item_id: str):
-    result = await db.queue.delete_one({"id": queue_item_id})
-    if result.deleted_count == 0:
+    removed = await db.queue.find_one_and_delete(queue_codec.query({"id": queue_item_id}))
+    if removed is None:
         raise HTTPException(status_code=404, detail="Queue item not found")
+    removed = queue_codec.decode(removed)
+    if removed["status"] == "waiting" and removed.get("schedule_keys"):
+        await withdraw_from_schedule(removed["priority"], removed["schedule_keys"])
+    await record_deletion("queue", queue_item_id)
     return {"message": "Removed from queue"}
 
 @api_router.get("/queue/completed", response_model=List[QueueItem])
 async def get_completed_queue():
-    completed_items = await db.queue.find({"status": "completed"}).sort("completed_at", -1).to_list(50)
-    return [QueueItem(**item) for item in completed_items]
+    completed_items = await db.queue.find(
+        queue_codec.query({"status": "completed"})
+    ).sort(queue_codec.field("completed_at"), -1).to_list(50)
+    return [QueueItem(**queue_codec.decode(item)) for item in completed_items]
 
 
 # Emergency Alert Route
@@ -245,7 +434,8 @@ async def trigger_emergency_alert():
 
 # Hygiene Rating Routes
 @api_router.post("/hygiene-rating", response_model=HygieneRating)
-async def create_hygiene_rating(rating_data: HygieneRatingCreate):
+@idempotency.idempotent
+async def create_hygiene_rating(rating_data: HygieneRatingCreate, idempotency_key: Optional[str] = Header(None)):
     user = await db.users.find_one({"id": rating_data.rated_by_user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -257,45 +447,150 @@ async def create_hygiene_rating(rating_data: HygieneRatingCreate):
         comment=rating_data.comment
     )
     
-    await db.hygiene_ratings.insert_one(rating.dict())
+    async with changes.write() as version:
+        await db.hygiene_ratings.insert_one(rating_codec.encode({**rating.dict(), "version": version}))
     return rating
 
 @api_router.get("/hygiene-rating/latest", response_model=Optional[HygieneRating])
 async def get_latest_hygiene_rating():
-    latest = await db.hygiene_ratings.find().sort("created_at", -1).limit(1).to_list(1)
-    return HygieneRating(**latest[0]) if latest else None
+    latest = await db.hygiene_ratings.find().sort(rating_codec.field("created_at"), -1).limit(1).to_list(1)
+    return HygieneRating(**rating_codec.decode(latest[0])) if latest else None
 
 @api_router.get("/hygiene-rating", response_model=List[HygieneRating])
 async def get_hygiene_ratings():
-    ratings = await db.hygiene_ratings.find().sort("created_at", -1).to_list(20)
-    return [HygieneRating(**rating) for rating in ratings]
+    ratings = await db.hygiene_ratings.find().sort(rating_codec.field("created_at"), -1).to_list(20)
+    return [HygieneRating(**rating_codec.decode(rating)) for rating in ratings]
 
 
 # Utilities Management Routes
+# Weight given to the newest gap between purchases when forecasting the next restock
+RESTOCK_SMOOTHING = 0.3
+
+async def pick_next_buyer(purchase_counts: Dict[str, int], last_buyer_id: str) -> Optional[Dict]:
+    # Whoever has bought this item the fewest times, taking turns in join order
+    # starting after the last buyer when there is a tie
+    users = await db.users.find().sort("created_at", 1).to_list(8)
+    if not users:
+        return None
+    user_ids = [u["id"] for u in users]
+    start = user_ids.index(last_buyer_id) + 1 if last_buyer_id in user_ids else 0
+    rotation = users[start:] + users[:start]
+    return min(rotation, key=lambda u: purchase_counts.get(u["id"], 0))
+
 @api_router.post("/utilities", response_model=UtilityItem)
-async def create_utility_item(utility_data: UtilityItemCreate):
+@idempotency.idempotent
+async def create_utility_item(utility_data: UtilityItemCreate, idempotency_key: Optional[str] = Header(None)):
     user = await db.users.find_one({"id": utility_data.last_bought_by_user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    purchase_counts = {user["id"]: 1}
+    next_buyer_user_id = utility_data.next_buyer_user_id
     next_buyer_name = None
-    if utility_data.next_buyer_user_id:
-        next_buyer = await db.users.find_one({"id": utility_data.next_buyer_user_id})
+    if next_buyer_user_id:
+        next_buyer = await db.users.find_one({"id": next_buyer_user_id})
         if next_buyer:
             next_buyer_name = next_buyer["name"]
+    else:
+        next_buyer = await pick_next_buyer(purchase_counts, user["id"])
+        if next_buyer:
+            next_buyer_user_id = next_buyer["id"]
+            next_buyer_name = next_buyer["name"]
     
     utility = UtilityItem(
         name=utility_data.name,
         last_bought_by_user_id=utility_data.last_bought_by_user_id,
         last_bought_by_name=user["name"],
         last_bought_date=datetime.utcnow(),
-        next_buyer_user_id=utility_data.next_buyer_user_id,
-        next_buyer_name=next_buyer_name
+        next_buyer_user_id=next_buyer_user_id,
+        next_buyer_name=next_buyer_name,
+        purchase_counts=purchase_counts
+    )
+    purchase = UtilityPurchase(
+        utility_id=utility.id,
+        bought_by_user_id=user["id"],
+        bought_by_name=user["name"],
+        bought_at=utility.last_bought_date
     )
     
-    await db.utilities.insert_one(utility.dict())
+    async with changes.write() as version:
+        await db.utilities.insert_one({**utility.dict(), "version": version})
+    await db.utility_purchases.insert_one(purchase.dict())
     return utility
 
+@api_router.post("/utilities/{utility_id}/purchase", response_model=UtilityItem)
+@idempotency.idempotent
+async def record_utility_purchase(utility_id: str, purchase_data: UtilityPurchaseCreate, idempotency_key: Optional[str] = Header(None)):
+    user = await db.users.find_one({"id": purchase_data.bought_by_user_id})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    existing = await db.utilities.find_one({"id": utility_id}, {"_id": 0, "last_bought_date": 1})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Utility item not found")
+    
+    purchase = UtilityPurchase(
+        utility_id=utility_id,
+        bought_by_user_id=user["id"],
+        bought_by_name=user["name"]
+    )
+    previous = await db.utility_purchases.find_one(
+        {"utility_id": utility_id, "bought_at": {"$lt": purchase.bought_at}},
+        sort=[("bought_at", -1)]
+    )
+    # Utilities created before purchases were logged only have the stored date
+    previous_bought_at = previous["bought_at"] if previous else existing.get("last_bought_date")
+    await db.utility_purchases.insert_one(purchase.dict())
+    
+    # Counts are incremented atomically so concurrent purchases are never lost
+    async with changes.write() as version:
+        utility = await db.utilities.find_one_and_update(
+            {"id": utility_id},
+            {
+                "$inc": {"purchase_count": 1, f"purchase_counts.{user['id']}": 1},
+                "$set": {
+                    "last_bought_by_user_id": user["id"],
+                    "last_bought_by_name": user["name"],
+                    "last_bought_date": purchase.bought_at,
+                    "version": version
+                }
+            },
+            return_document=ReturnDocument.AFTER
+        )
+    if utility is None:
+        raise HTTPException(status_code=404, detail="Utility item not found")
+    
+    # Keep the forecast and next buyer up to date here so reads never have to scan the history
+    updates = {}
+    average_interval_hours = utility.get("average_interval_hours")
+    if previous_bought_at:
+        interval_hours = (purchase.bought_at - previous_bought_at).total_seconds() / 3600
+        if average_interval_hours is None:
+            average_interval_hours = interval_hours
+        else:
+            average_interval_hours = (
+                RESTOCK_SMOOTHING * interval_hours + (1 - RESTOCK_SMOOTHING) * average_interval_hours
+            )
+        updates["average_interval_hours"] = average_interval_hours
+        updates["predicted_restock_date"] = purchase.bought_at + timedelta(hours=average_interval_hours)
+    
+    next_buyer = await pick_next_buyer(utility.get("purchase_counts", {}), user["id"])
+    updates["next_buyer_user_id"] = next_buyer["id"] if next_buyer else None
+    updates["next_buyer_name"] = next_buyer["name"] if next_buyer else None
+    
+    # If another purchase has landed since, it has already worked these out from newer counts
+    async with changes.write() as version:
+        await db.utilities.update_one(
+            {"id": utility_id, "purchase_count": utility["purchase_count"]},
+            {"$set": {**updates, "version": version}}
+        )
+    return UtilityItem(**{**utility, **updates})
+
+@api_router.get("/utilities/{utility_id}/purchases", response_model=List[UtilityPurchase])
+async def get_utility_purchases(utility_id: str, limit: int = Query(50, ge=1, le=500)):
+    purchases = await db.utility_purchases.find({"utility_id": utility_id}).sort("bought_at", -1).to_list(limit)
+    return [UtilityPurchase(**purchase) for purchase in purchases]
+
 @api_router.get("/utilities", response_model=List[UtilityItem])
 async def get_utilities():
     utilities = await db.utilities.find().sort("created_at", -1).to_list(50)
@@ -307,15 +602,17 @@ async def update_next_buyer(utility_id: str, next_buyer_user_id: str):
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    result = await db.utilities.update_one(
-        {"id": utility_id},
-        {
-            "$set": {
-                "next_buyer_user_id": next_buyer_user_id,
-                "next_buyer_name": user["name"]
+    async with changes.write() as version:
+        result = await db.utilities.update_one(
+            {"id": utility_id},
+            {
+                "$set": {
+                    "next_buyer_user_id": next_buyer_user_id,
+                    "next_buyer_name": user["name"],
+                    "version": version
+                }
             }
-        }
-    )
+        )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Utility item not found")
@@ -323,19 +620,144 @@ async def update_next_buyer(utility_id: str, next_buyer_user_id: str):
     return {"message": "Next buyer updated successfully"}
 
 
+# Export Routes
+# Each export streams straight off a Motor cursor in batches so memory use stays
+# flat no matter how much history there is.
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_SOURCES = {
+    "queue": ("queue", QueueItem, "completed_at", {"status": "completed"}),
+    "hygiene-ratings": ("hygiene_ratings", HygieneRating, "created_at", {}),
+    "utilities": ("utilities", UtilityItem, "last_bought_date", {}),
+    "utility-purchases": ("utility_purchases", UtilityPurchase, "bought_at", {}),
+}
+
+async def stream_export(cursor, model, codec: DocumentCodec, export_format: ExportFormat):
+    fields = list(model.model_fields)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    if export_format == ExportFormat.CSV:
+        writer.writeheader()
+        yield buffer.getvalue()
+    async for doc in cursor:
+        item = model(**codec.decode(doc)).model_dump(mode="json")
+        if export_format == ExportFormat.NDJSON:
+            yield json.dumps(item) + "\n"
+        else:
+            buffer.seek(0)
+            buffer.truncate()
+            # Nested values such as purchase_counts go into a single cell as JSON
+            writer.writerow({
+                key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                for key, value in item.items()
+            })
+            yield buffer.getvalue()
+
+@api_router.get("/export/{source}")
+async def export_history(
+    source: str,
+    format: ExportFormat = ExportFormat.NDJSON,
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+):
+    if source not in EXPORT_SOURCES:
+        raise HTTPException(status_code=404, detail="Unknown export source")
+    collection_name, model, date_field, query = EXPORT_SOURCES[source]
+
+    query = dict(query)
+    date_range = {}
+    if start:
+        date_range["$gte"] = start
+    if end:
+        date_range["$lt"] = end
+    if date_range:
+        query[date_field] = date_range
+
+    codec = storage_codecs.get(collection_name, plain_codec)
+    cursor = db[collection_name].find(codec.query(query)).sort(codec.field(date_field), 1).batch_size(EXPORT_BATCH_SIZE)
+    media_type = "application/x-ndjson" if format == ExportFormat.NDJSON else "text/csv"
+    filename = f"{source}.{format.value}"
+    return StreamingResponse(
+        stream_export(cursor, model, codec, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# Delta Sync Route
+@api_router.get("/changes", response_model=ChangesFeed)
+async def get_changes(since: int = 0, limit: int = Query(500, ge=1, le=5000)):
+    # Only report versions that every earlier write has already committed under
+    version = await changes.committed_version()
+    feed = ChangesFeed(version=version)
+    if since >= version:
+        return feed
+    if since > 0:
+        pruned = await db.counters.find_one({"_id": "deletions"})
+        if pruned and since < pruned["pruned_through"]:
+            raise HTTPException(
+                status_code=410,
+                detail="Changes since this version are no longer available, resync with since=0"
+            )
+
+    # Versions are unique across collections, so the first `limit` of each list
+    # always contains the first `limit` overall
+    changed = {"$gt": since, "$lte": version}
+    entries = []
+    for collection, model in SYNCED_COLLECTIONS.items():
+        codec = storage_codecs.get(collection, plain_codec)
+        docs = await db[collection].find(
+            codec.query({"version": changed})
+        ).sort(codec.field("version"), 1).to_list(limit + 1)
+        for doc in map(codec.decode, docs):
+            entries.append((doc["version"], collection, model(**doc)))
+    tombstones = await db.deletions.find({"version": changed}).sort("version", 1).to_list(limit + 1)
+    entries.extend((tombstone["version"], "deleted", tombstone) for tombstone in tombstones)
+
+    entries.sort(key=lambda entry: entry[0])
+    if len(entries) > limit:
+        entries = entries[:limit]
+        feed.version = entries[-1][0]
+        feed.has_more = True
+
+    for _, collection, item in entries:
+        if collection == "deleted":
+            feed.deleted.setdefault(item["collection"], []).append(item["id"])
+        else:
+            getattr(feed, collection).append(item)
+
+    return feed
+
+
 # Bathroom State Route
 @api_router.get("/bathroom-state", response_model=BathroomState)
 async def get_bathroom_state():
-    current_user = await db.queue.find_one({"status": "using"})
-    latest_rating = await db.hygiene_ratings.find().sort("created_at", -1).limit(1).to_list(1)
+    current_user = await db.queue.find_one(queue_codec.query({"status": "using"}))
+    latest_rating = await db.hygiene_ratings.find().sort(rating_codec.field("created_at"), -1).limit(1).to_list(1)
     
     return BathroomState(
         is_occupied=current_user is not None,
-        current_user=QueueItem(**current_user).dict() if current_user else None,
-        last_hygiene_rating=HygieneRating(**latest_rating[0]).dict() if latest_rating else None
+        current_user=QueueItem(**queue_codec.decode(current_user)).dict() if current_user else None,
+        last_hygiene_rating=HygieneRating(**rating_codec.decode(latest_rating[0])).dict() if latest_rating else None
     )
 
 
+# Admin Routes
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not admin_token_matches(admin_token, x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@api_router.get("/admin/profiling", dependencies=[Depends(require_admin)])
+async def get_profiling():
+    return profiler.snapshot()
+
+@api_router.put("/admin/profiling", dependencies=[Depends(require_admin)])
+async def update_profiling(settings: ProfilingSettingsUpdate):
+    for field, value in settings.dict(exclude_none=True).items():
+        setattr(profiler, field, value)
+    return profiler.settings()
+
+
 # Health check
 @api_router.get("/")
 async def root():
@@ -345,6 +767,7 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(ProfilingMiddleware, profiler=profiler, admin_token=admin_token)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -360,6 +783,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    for collection in [*SYNCED_COLLECTIONS, "deletions"]:
+        codec = storage_codecs.get(collection, plain_codec)
+        await db[collection].create_index(codec.field("version"))
+    for name in scheduling_policies:
+        await db.queue.create_index([
+            (queue_codec.field("status"), 1),
+            (queue_codec.field(f"schedule_keys.{name}"), 1)
+        ])
+    await db.queue.create_index([(queue_codec.field("status"), 1), (queue_codec.field("completed_at"), 1)])
+    await db.hygiene_ratings.create_index(rating_codec.field("created_at"))
+    await db.utilities.create_index("last_bought_date")
+    await db.deletions.create_index("deleted_at")
+    await db.utility_purchases.create_index([("utility_id", 1), ("bought_at", -1)])
+    await db.utility_purchases.create_index("bought_at")
+    await idempotency.create_indexes()
+    await changes.create_indexes()
+
+@app.on_event("startup")
+async def backfill_purchase_counts():
+    # Utilities created before purchases were counted have been bought once
+    await db.utilities.update_many({"purchase_count": {"$exists": False}}, {"$set": {"purchase_count": 1}})
+
+@app.on_event("startup")
+async def backfill_versions():
+    # Documents written before change tracking existed still need a version, or a
+    # client syncing from scratch would never see them
+    for collection in SYNCED_COLLECTIONS:
+        codec = storage_codecs.get(collection, plain_codec)
+        async for doc in db[collection].find(codec.query({"version": {"$exists": False}}), {"_id": 1}):
+            async with changes.write() as version:
+                await db[collection].update_one(
+                    {"_id": doc["_id"]},
+                    {"$set": {codec.field("version"): version}}
+                )
+
+@app.on_event("startup")
+async def restore_scheduling_state():
+    state = await db.counters.find_one({"_id": "scheduling"}) or {}
+    for name, policy in scheduling_policies.items():
+        policy.load_state(state.get(name, {}))
+    
+    # Entries queued before scheduling keys existed (or before a new policy was added)
+    missing = {"status": "waiting", "$or": [
+        {f"schedule_keys.{name}": {"$exists": False}} for name in scheduling_policies
+    ]}
+    async for item in db.queue.find(queue_codec.query(missing)).sort(queue_codec.field("created_at"), 1):
+        item = queue_codec.decode(item)
+        # Only admit to the policies the entry has no key for; re-admitting to the
+        # others would reorder the live queue and advance their state twice
+        names = [name for name in scheduling_policies if name not in item.get("schedule_keys", {})]
+        keys = await admit_to_schedule(item["priority"], item["created_at"], names)
+        await db.queue.update_one(
+            queue_codec.query({"id": item["id"]}),
+            queue_codec.update({"$set": {f"schedule_keys.{name}": key for name, key in keys.items()}})
+        )
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    profiler.loop_lag.start()
+
+@app.on_event("startup")
+async def start_deletion_pruning():
+    app.state.deletion_pruner = asyncio.create_task(prune_deletions_periodically())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    profiler.loop_lag.stop()
+    app.state.deletion_pruner.cancel()
     client.close()
\ No newline at end of file
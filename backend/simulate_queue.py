@@ -0,0 +1,104 @@
+"""Replay a recorded queue trace under each scheduling policy and compare wait times.
+
+The trace is the NDJSON produced by `GET /api/export/queue`: one completed session
+per line with `priority`, `created_at`, `started_at` and `completed_at`. Arrivals
+are replayed against a single bathroom, keeping each session's recorded duration.
+
+    python simulate_queue.py queue.ndjson
+    python simulate_queue.py queue.ndjson --aging-seconds 300
+"""
+import argparse
+import json
+from datetime import datetime
+from typing import Dict, List
+
+from scheduling import AgingPolicy, PolicyQueue, StrictPriorityPolicy, WeightedFairPolicy
+
+
+def load_trace(path: str, default_service: float) -> List[Dict]:
+    arrivals = []
+    with open(path) as trace:
+        for line in trace:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            created_at = datetime.fromisoformat(record["created_at"]).timestamp()
+            service = default_service
+            if record.get("started_at") and record.get("completed_at"):
+                service = (
+                    datetime.fromisoformat(record["completed_at"])
+                    - datetime.fromisoformat(record["started_at"])
+                ).total_seconds()
+            arrivals.append({"priority": record["priority"], "arrived_at": created_at, "service": service})
+    arrivals.sort(key=lambda arrival: arrival["arrived_at"])
+    return arrivals
+
+
+def simulate(arrivals: List[Dict], policy) -> List[Dict]:
+    queue = PolicyQueue(policy)
+    waits = []
+    clock = arrivals[0]["arrived_at"] if arrivals else 0.0
+    next_arrival = 0
+
+    while next_arrival < len(arrivals) or queue:
+        # Everyone who showed up while the bathroom was busy joins the queue
+        while next_arrival < len(arrivals) and arrivals[next_arrival]["arrived_at"] <= clock:
+            arrival = arrivals[next_arrival]
+            queue.push(arrival, arrival["priority"], arrival["arrived_at"])
+            next_arrival += 1
+        if not queue:
+            clock = arrivals[next_arrival]["arrived_at"]
+            continue
+
+        arrival = queue.pop()
+        waits.append({"priority": arrival["priority"], "wait": clock - arrival["arrived_at"]})
+        clock += arrival["service"]
+
+    return waits
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(waits: List[Dict]) -> Dict[str, Dict[str, float]]:
+    groups = {"all": [w["wait"] for w in waits]}
+    for w in waits:
+        groups.setdefault(w["priority"], []).append(w["wait"])
+    return {
+        group: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.50),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        }
+        for group, values in groups.items()
+        if values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="NDJSON export of completed queue sessions")
+    parser.add_argument("--aging-seconds", type=float, default=600)
+    parser.add_argument("--service-seconds", type=float, default=300,
+                        help="Session length to assume when the trace has none")
+    args = parser.parse_args()
+
+    arrivals = load_trace(args.trace, args.service_seconds)
+    policies = [StrictPriorityPolicy(), AgingPolicy(args.aging_seconds), WeightedFairPolicy()]
+
+    print(f"{'policy':<8} {'priority':<10} {'count':>6} {'mean':>9} {'p50':>9} {'p99':>9} {'max':>9}")
+    for policy in policies:
+        for group, stats in summarize(simulate(arrivals, policy)).items():
+            print(
+                f"{policy.name:<8} {group:<10} {stats['count']:>6} {stats['mean']:>9.1f} "
+                f"{stats['p50']:>9.1f} {stats['p99']:>9.1f} {stats['max']:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
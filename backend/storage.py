@@ -0,0 +1,157 @@
+"""Compact on-disk encoding for queue and hygiene rating documents.
+
+With compact storage on, documents are written with short field names, the
+UUID string `id` becomes a binary `_id`, other UUIDs are stored as binary,
+enum strings become small integers, and unset fields are left out. A codec
+translates documents, filters, updates, projections and sort keys between
+the API field names and the stored ones, so the route code only ever deals
+with the API shape. With compact storage off, every translation is a no-op.
+"""
+import uuid
+from typing import Dict, Iterable, Optional
+
+from bson.binary import Binary
+
+
+PRIORITY_CODES = {"emergency": 0, "work": 1, "health": 2}
+STATUS_CODES = {"waiting": 0, "using": 1, "completed": 2}
+COLOR_CODES = {
+    "red": 0, "blue": 1, "green": 2, "yellow": 3,
+    "orange": 4, "purple": 5, "pink": 6, "cyan": 7,
+}
+
+LIST_OPERATORS = {"$in", "$nin"}
+RAW_OPERATORS = {"$exists", "$type"}
+
+
+class DocumentCodec:
+    def __init__(self, fields: Optional[Dict[str, str]] = None,
+                 enums: Optional[Dict[str, Dict[str, int]]] = None,
+                 uuid_fields: Iterable[str] = (), compact: bool = True):
+        self.compact = compact
+        self.fields = fields or {}
+        self.long_names = {short: name for name, short in self.fields.items()}
+        self.enums = enums or {}
+        self.enum_names = {
+            name: {code: value for value, code in codes.items()}
+            for name, codes in self.enums.items()
+        }
+        self.uuid_fields = set(uuid_fields)
+
+    def field(self, name: str) -> str:
+        if not self.compact:
+            return name
+        head, dot, rest = name.partition(".")
+        return self.fields.get(head, head) + dot + rest
+
+    def encode_value(self, name: str, value):
+        if not self.compact or value is None:
+            return value
+        value = getattr(value, "value", value)
+        if name in self.enums:
+            return self.enums[name].get(value, value)
+        if name in self.uuid_fields:
+            try:
+                return Binary.from_uuid(uuid.UUID(value))
+            except (TypeError, ValueError, AttributeError):
+                # Not a UUID, so it cannot match anything stored; keep it as is
+                return value
+        return value
+
+    def decode_value(self, name: str, value):
+        if name in self.enum_names:
+            return self.enum_names[name].get(value, value)
+        if name in self.uuid_fields and isinstance(value, Binary):
+            return str(value.as_uuid())
+        return value
+
+    def encode(self, doc: Dict) -> Dict:
+        if not self.compact:
+            return doc
+        return {
+            self.field(name): self.encode_value(name, value)
+            for name, value in doc.items()
+            if value is not None
+        }
+
+    def decode(self, doc: Optional[Dict]) -> Optional[Dict]:
+        if not self.compact or doc is None:
+            return doc
+        decoded = {}
+        for short, value in doc.items():
+            name = self.long_names.get(short, short)
+            decoded[name] = self.decode_value(name, value)
+        return decoded
+
+    def query(self, filter: Dict) -> Dict:
+        if not self.compact:
+            return filter
+        translated = {}
+        for key, condition in filter.items():
+            if key in ("$and", "$or", "$nor"):
+                translated[key] = [self.query(clause) for clause in condition]
+            else:
+                translated[self.field(key)] = self._condition(key.partition(".")[0], condition)
+        return translated
+
+    def _condition(self, name: str, condition):
+        if not (isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition)):
+            return self.encode_value(name, condition)
+        translated = {}
+        for op, operand in condition.items():
+            if op in LIST_OPERATORS:
+                translated[op] = [self.encode_value(name, value) for value in operand]
+            elif op in RAW_OPERATORS:
+                translated[op] = operand
+            else:
+                translated[op] = self.encode_value(name, operand)
+        return translated
+
+    def update(self, update: Dict) -> Dict:
+        if not self.compact:
+            return update
+        return {
+            op: {self.field(name): self.encode_value(name, value) for name, value in fields.items()}
+            for op, fields in update.items()
+        }
+
+    def projection(self, projection: Dict) -> Dict:
+        return {self.field(name): include for name, include in projection.items()}
+
+
+def queue_storage(compact: bool) -> DocumentCodec:
+    return DocumentCodec(
+        fields={
+            "id": "_id",
+            "user_id": "u",
+            "user_name": "n",
+            "user_color": "c",
+            "priority": "p",
+            "status": "s",
+            "reason": "r",
+            "created_at": "t",
+            "started_at": "ts",
+            "completed_at": "tc",
+            "schedule_keys": "k",
+            "version": "v",
+        },
+        enums={"priority": PRIORITY_CODES, "status": STATUS_CODES, "user_color": COLOR_CODES},
+        uuid_fields=["id", "user_id"],
+        compact=compact,
+    )
+
+
+def hygiene_rating_storage(compact: bool) -> DocumentCodec:
+    return DocumentCodec(
+        fields={
+            "id": "_id",
+            "rated_by_user_id": "u",
+            "rated_by_name": "n",
+            "rating": "r",
+            "comment": "m",
+            "created_at": "t",
+            "version": "v",
+        },
+        uuid_fields=["id", "rated_by_user_id"],
+        compact=compact,
+    )
@@ -1,4 +1,5 @@
 import requests
+import os
 import unittest
 import json
 import time
@@ -422,6 +423,237 @@ def test_validation_rules():
     
     print("✅ Validation Rules tests passed")
 
+def test_history_export():
+    """Test streaming history export API endpoints"""
+    print("\n--- Testing History Export API ---")
+    
+    # Create a test user with a rating to export
+    user = create_user()
+    rating_data = {"rated_by_user_id": user["id"], "rating": 5, "comment": "Spotless, really"}
+    response = requests.post(f"{BACKEND_URL}/hygiene-rating", json=rating_data)
+    assert response.status_code == 200
+    rating = response.json()
+    
+    # Test NDJSON export (one JSON document per line)
+    response = requests.get(f"{BACKEND_URL}/export/hygiene-ratings")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in response.text.splitlines() if line]
+    assert any(item["id"] == rating["id"] for item in exported)
+    
+    # Test CSV export (header row first)
+    response = requests.get(f"{BACKEND_URL}/export/hygiene-ratings?format=csv")
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0].startswith("id,rated_by_user_id")
+    assert any(rating["id"] in line for line in lines[1:])
+    
+    # Test date range filtering (nothing in the far future)
+    response = requests.get(f"{BACKEND_URL}/export/hygiene-ratings?start=2999-01-01T00:00:00")
+    assert response.status_code == 200
+    assert response.text == ""
+    
+    # Test unknown export source
+    response = requests.get(f"{BACKEND_URL}/export/unknown")
+    assert response.status_code == 404
+    
+    print("✅ History Export API tests passed")
+
+def test_changes_feed():
+    """Test delta sync changes feed API endpoint"""
+    print("\n--- Testing Changes Feed API ---")
+    
+    # Get the current version
+    response = requests.get(f"{BACKEND_URL}/changes")
+    assert response.status_code == 200
+    version = response.json()["version"]
+    
+    # Nothing changed since the current version
+    response = requests.get(f"{BACKEND_URL}/changes?since={version}")
+    assert response.status_code == 200
+    feed = response.json()
+    assert feed["users"] == []
+    assert feed["deleted"] == {}
+    
+    # Create a user and check it shows up in the feed
+    user = create_user()
+    response = requests.get(f"{BACKEND_URL}/changes?since={version}")
+    assert response.status_code == 200
+    feed = response.json()
+    assert feed["version"] > version
+    assert any(u["id"] == user["id"] for u in feed["users"])
+    
+    # Delete the user and check the tombstone
+    requests.delete(f"{BACKEND_URL}/users/{user['id']}")
+    response = requests.get(f"{BACKEND_URL}/changes?since={feed['version']}")
+    assert response.status_code == 200
+    feed = response.json()
+    assert user["id"] in feed["deleted"]["users"]
+    
+    # Test paging through the feed from scratch
+    response = requests.get(f"{BACKEND_URL}/changes?since=0&limit=1")
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["users"]) + len(page["queue"]) + len(page["hygiene_ratings"]) + len(page["utilities"]) \
+        + sum(len(ids) for ids in page["deleted"].values()) == 1
+    assert page["has_more"]
+    assert page["version"] < feed["version"]
+    
+    print("✅ Changes Feed API tests passed")
+
+def test_queue_scheduling_policies():
+    """Test queue ordering under each scheduling policy"""
+    print("\n--- Testing Queue Scheduling Policies API ---")
+    
+    # Create test users and join the queue, health first
+    user = create_user()
+    queue_data = {"user_id": user["id"], "priority": "health"}
+    response = requests.post(f"{BACKEND_URL}/queue", json=queue_data)
+    assert response.status_code == 200
+    queue_item = response.json()
+    
+    user2 = create_user()
+    emergency_data = {"user_id": user2["id"], "priority": "emergency"}
+    response = requests.post(f"{BACKEND_URL}/queue", json=emergency_data)
+    assert response.status_code == 200
+    emergency_item = response.json()
+    
+    # Every policy returns both waiting entries
+    for policy in ["strict", "aging", "fair"]:
+        response = requests.get(f"{BACKEND_URL}/queue?policy={policy}")
+        assert response.status_code == 200
+        queue_ids = [item["id"] for item in response.json()]
+        assert queue_item["id"] in queue_ids
+        assert emergency_item["id"] in queue_ids
+    
+    # Strict priority puts the later emergency ahead of the waiting health entry
+    response = requests.get(f"{BACKEND_URL}/queue?policy=strict")
+    queue_ids = [item["id"] for item in response.json()]
+    assert queue_ids.index(emergency_item["id"]) < queue_ids.index(queue_item["id"])
+    
+    # Test unknown policy
+    response = requests.get(f"{BACKEND_URL}/queue?policy=unknown")
+    assert response.status_code == 400
+    assert "Unknown scheduling policy" in response.json()["detail"]
+    
+    requests.delete(f"{BACKEND_URL}/queue/{queue_item['id']}")
+    requests.delete(f"{BACKEND_URL}/queue/{emergency_item['id']}")
+    
+    print("✅ Queue Scheduling Policies API tests passed")
+
+def test_utility_purchases():
+    """Test utility purchase history and next buyer rotation API endpoints"""
+    print("\n--- Testing Utility Purchases API ---")
+    
+    # Create test users
+    user1 = create_user(name="First Buyer")
+    user2 = create_user(name="Second Buyer")
+    
+    # Next buyer is assigned automatically when none is given
+    utility_data = {"name": "Soap", "last_bought_by_user_id": user1["id"]}
+    response = requests.post(f"{BACKEND_URL}/utilities", json=utility_data)
+    assert response.status_code == 200
+    utility = response.json()
+    assert utility["purchase_count"] == 1
+    assert utility["next_buyer_user_id"] is not None
+    assert utility["next_buyer_user_id"] != user1["id"]
+    
+    # Test recording a purchase
+    purchase_data = {"bought_by_user_id": user2["id"]}
+    response = requests.post(f"{BACKEND_URL}/utilities/{utility['id']}/purchase", json=purchase_data)
+    assert response.status_code == 200
+    utility = response.json()
+    assert utility["last_bought_by_user_id"] == user2["id"]
+    assert utility["purchase_count"] == 2
+    assert utility["average_interval_hours"] is not None
+    assert utility["predicted_restock_date"] is not None
+    assert utility["next_buyer_user_id"] != user2["id"]
+    
+    # Test getting purchase history (newest first)
+    response = requests.get(f"{BACKEND_URL}/utilities/{utility['id']}/purchases")
+    assert response.status_code == 200
+    purchases = response.json()
+    assert len(purchases) == 2
+    assert purchases[0]["bought_by_user_id"] == user2["id"]
+    
+    # Test purchase for a non-existent utility
+    response = requests.post(f"{BACKEND_URL}/utilities/non-existent-id/purchase", json=purchase_data)
+    assert response.status_code == 404
+    
+    print("✅ Utility Purchases API tests passed")
+
+def test_profiling_admin():
+    """Test profiling admin API endpoints"""
+    print("\n--- Testing Profiling Admin API ---")
+    
+    # Test that admin endpoints refuse requests without a valid token
+    response = requests.get(f"{BACKEND_URL}/admin/profiling")
+    assert response.status_code == 403
+    response = requests.get(f"{BACKEND_URL}/admin/profiling", headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == 403
+    
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token:
+        print("ADMIN_TOKEN not set, skipping authenticated profiling checks")
+        return
+    admin_headers = {"X-Admin-Token": admin_token}
+    
+    # Force a profiled request
+    response = requests.get(f"{BACKEND_URL}/users", headers={"X-Profile": "1", **admin_headers})
+    assert response.status_code == 200
+    
+    # Test reading the profiling snapshot
+    response = requests.get(f"{BACKEND_URL}/admin/profiling", headers=admin_headers)
+    assert response.status_code == 200
+    snapshot = response.json()
+    assert snapshot["settings"]["enabled"]
+    assert "get_users" in snapshot["routes"]
+    assert "loop_lag" in snapshot
+    assert isinstance(snapshot["slow_requests"], list)
+    
+    # Test updating settings
+    sample_rate = snapshot["settings"]["sample_rate"]
+    response = requests.put(f"{BACKEND_URL}/admin/profiling", json={"sample_rate": 0.5}, headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["sample_rate"] == 0.5
+    requests.put(f"{BACKEND_URL}/admin/profiling", json={"sample_rate": sample_rate}, headers=admin_headers)
+    
+    # Test invalid sample rate
+    response = requests.put(f"{BACKEND_URL}/admin/profiling", json={"sample_rate": 2}, headers=admin_headers)
+    assert response.status_code == 422
+    
+    print("✅ Profiling Admin API tests passed")
+
+def test_idempotency_keys():
+    """Test Idempotency-Key handling on write endpoints"""
+    print("\n--- Testing Idempotency Keys ---")
+    
+    # Create a test user
+    user = create_user()
+    headers = {"Idempotency-Key": f"test-{random_string(16)}"}
+    
+    # Test retrying a queue join with the same key
+    queue_data = {"user_id": user["id"], "priority": "work"}
+    response = requests.post(f"{BACKEND_URL}/queue", json=queue_data, headers=headers)
+    assert response.status_code == 200
+    queue_item = response.json()
+    
+    response = requests.post(f"{BACKEND_URL}/queue", json=queue_data, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["id"] == queue_item["id"]
+    
+    # Without a key the duplicate is still rejected
+    response = requests.post(f"{BACKEND_URL}/queue", json=queue_data)
+    assert response.status_code == 400
+    
+    # Test reusing a key with a different request
+    response = requests.post(f"{BACKEND_URL}/queue", json={**queue_data, "priority": "health"}, headers=headers)
+    assert response.status_code == 422
+    
+    requests.delete(f"{BACKEND_URL}/queue/{queue_item['id']}")
+    
+    print("✅ Idempotency Keys tests passed")
+
 def run_all_tests():
     """Run all test functions"""
     print("\n=== Running All Bathroom Queue API Tests ===\n")
@@ -438,6 +670,12 @@ def run_all_tests():
         test_hygiene_rating_system()
         test_utilities_tracking()
         test_validation_rules()
+        test_history_export()
+        test_changes_feed()
+        test_queue_scheduling_policies()
+        test_utility_purchases()
+        test_profiling_admin()
+        test_idempotency_keys()
         
         print("\n=== All Tests Completed Successfully ===")
     finally:
@@ -0,0 +1,181 @@
+"""In-memory stand-in for the handful of Motor collection calls the backend makes."""
+import copy
+from types import SimpleNamespace
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+def _lookup(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return False, None
+        doc = doc[part]
+    return True, doc
+
+
+def _compare(op, value, operand):
+    if op == "$exists":
+        return operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if op == "$ne":
+        return value != operand
+    if value is None:
+        return False
+    return {
+        "$gt": lambda: value > operand,
+        "$gte": lambda: value >= operand,
+        "$lt": lambda: value < operand,
+        "$lte": lambda: value <= operand,
+    }[op]()
+
+
+def matches(doc, filter):
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+            continue
+        found, value = _lookup(doc, key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$exists":
+                    if found != operand:
+                        return False
+                elif not found or not _compare(op, value, operand):
+                    return False
+        elif not found or value != condition:
+            return False
+    return True
+
+
+def _set_path(doc, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def apply_update(doc, update):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                _set_path(doc, path, value)
+            elif op == "$inc":
+                _, current = _lookup(doc, path)
+                _set_path(doc, path, (current or 0) + value)
+            else:
+                raise NotImplementedError(op)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction=1):
+        self.docs.sort(key=lambda doc: _lookup(doc, field)[1], reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        self._iter = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, unique=()):
+        self.docs = []
+        self.unique = unique
+        self._next_id = 0
+
+    def _find(self, filter):
+        return [doc for doc in self.docs if matches(doc, filter or {})]
+
+    def _check_unique(self, doc):
+        for field in ("_id", *self.unique):
+            if field in doc and any(other.get(field) == doc[field] for other in self.docs if other is not doc):
+                raise DuplicateKeyError(f"duplicate {field}")
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def insert_one(self, doc):
+        if "_id" not in doc:
+            self._next_id += 1
+            doc["_id"] = self._next_id
+        self._check_unique(doc)
+        self.docs.append(copy.deepcopy(doc))
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def find_one(self, filter=None, projection=None, sort=None):
+        docs = self._find(filter)
+        if sort:
+            field, direction = sort[0]
+            docs.sort(key=lambda doc: _lookup(doc, field)[1], reverse=direction < 0)
+        return copy.deepcopy(docs[0]) if docs else None
+
+    def find(self, filter=None, projection=None):
+        return FakeCursor([copy.deepcopy(doc) for doc in self._find(filter)])
+
+    async def find_one_and_update(self, filter, update, upsert=False, return_document=ReturnDocument.BEFORE,
+                                  projection=None):
+        docs = self._find(filter)
+        if not docs:
+            if not upsert:
+                return None
+            doc = {key: value for key, value in filter.items() if not key.startswith("$")}
+            self.docs.append(doc)
+            before = None
+        else:
+            doc = docs[0]
+            before = copy.deepcopy(doc)
+        apply_update(doc, update)
+        return copy.deepcopy(doc) if return_document == ReturnDocument.AFTER else before
+
+    async def update_one(self, filter, update, upsert=False):
+        docs = self._find(filter)
+        if not docs:
+            return SimpleNamespace(matched_count=0, modified_count=0)
+        apply_update(docs[0], update)
+        return SimpleNamespace(matched_count=1, modified_count=1)
+
+    async def replace_one(self, filter, replacement, upsert=False):
+        docs = self._find(filter)
+        replacement = copy.deepcopy(replacement)
+        if docs:
+            replacement.setdefault("_id", docs[0]["_id"])
+            self.docs[self.docs.index(docs[0])] = replacement
+        elif upsert:
+            await self.insert_one(replacement)
+        return SimpleNamespace(matched_count=len(docs[:1]))
+
+    async def delete_one(self, filter):
+        docs = self._find(filter)
+        if docs:
+            self.docs.remove(docs[0])
+        return SimpleNamespace(deleted_count=len(docs[:1]))
+
+    async def drop_indexes(self):
+        pass
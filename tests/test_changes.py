@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from changes import ChangeTracker
+from tests.fakes import FakeCollection
+
+
+def test_versions_increase():
+    async def scenario():
+        tracker = ChangeTracker(FakeCollection(), FakeCollection())
+        seen = []
+        for _ in range(3):
+            async with tracker.write() as version:
+                seen.append(version)
+        assert seen == [1, 2, 3]
+        assert await tracker.committed_version() == 3
+
+    asyncio.run(scenario())
+
+
+def test_interleaved_writes_never_skip_an_uncommitted_version():
+    async def scenario():
+        tracker = ChangeTracker(FakeCollection(), FakeCollection())
+        documents = FakeCollection()
+        a_has_version = asyncio.Event()
+        b_committed = asyncio.Event()
+
+        async def write_a():
+            async with tracker.write() as version:
+                a_has_version.set()
+                # B takes a later version and commits while A is still writing
+                await b_committed.wait()
+                await documents.insert_one({"name": "a", "version": version})
+
+        async def write_b():
+            await a_has_version.wait()
+            async with tracker.write() as version:
+                await documents.insert_one({"name": "b", "version": version})
+            b_committed.set()
+
+        async def poll(since):
+            version = await tracker.committed_version()
+            docs = await documents.find({"version": {"$gt": since, "$lte": version}}).to_list(None)
+            return version, {doc["name"] for doc in docs}
+
+        task_a = asyncio.create_task(write_a())
+        await write_b()
+
+        # A holds the older version, so the feed must not move past it yet
+        version, names = await poll(0)
+        assert version == 0
+        assert names == set()
+
+        await task_a
+        version, names = await poll(version)
+        assert version == 2
+        assert names == {"a", "b"}
+
+    asyncio.run(scenario())
+
+
+def test_stale_markers_stop_holding_the_feed_back():
+    async def scenario():
+        in_flight = FakeCollection()
+        tracker = ChangeTracker(FakeCollection(), in_flight, stale_after=30)
+        async with tracker.write():
+            pass
+        # A writer that crashed an hour ago without clearing its marker
+        await in_flight.insert_one({"floor": 0, "at": datetime.utcnow() - timedelta(hours=1)})
+        assert await tracker.committed_version() == 1
+
+        await in_flight.insert_one({"floor": 0, "at": datetime.utcnow()})
+        assert await tracker.committed_version() == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,137 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from idempotency import IdempotencyCache
+from tests.fakes import FakeCollection
+
+
+def make_handler(calls, gate=None):
+    async def create_thing(name, idempotency_key=None):
+        calls.append(name)
+        if gate is not None:
+            await gate.wait()
+        return {"id": len(calls), "name": name}
+
+    return create_thing
+
+
+def test_duplicate_in_another_process_replays_instead_of_running():
+    async def scenario():
+        # Two caches over one collection stand in for two server processes
+        collection = FakeCollection(unique=("key",))
+        first = IdempotencyCache(collection, poll_interval=0.001)
+        second = IdempotencyCache(collection, poll_interval=0.001)
+        calls = []
+        gate = asyncio.Event()
+        handler = make_handler(calls, gate)
+
+        original = asyncio.create_task(first.idempotent(handler)(name="a", idempotency_key="k"))
+        retry = asyncio.create_task(second.idempotent(handler)(name="a", idempotency_key="k"))
+        await asyncio.sleep(0.01)
+        assert calls == ["a"]
+
+        gate.set()
+        assert await original == await retry == {"id": 1, "name": "a"}
+        assert calls == ["a"]
+
+    asyncio.run(scenario())
+
+
+def test_failed_handler_releases_the_key():
+    async def scenario():
+        cache = IdempotencyCache(FakeCollection(unique=("key",)))
+        calls = []
+
+        async def flaky(name, idempotency_key=None):
+            calls.append(name)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return {"name": name}
+
+        with pytest.raises(RuntimeError):
+            await cache.idempotent(flaky)(name="a", idempotency_key="k")
+        assert await cache.idempotent(flaky)(name="a", idempotency_key="k") == {"name": "a"}
+        assert calls == ["a", "a"]
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_gives_up_while_the_original_is_still_running():
+    async def scenario():
+        collection = FakeCollection(unique=("key",))
+        first = IdempotencyCache(collection)
+        second = IdempotencyCache(collection, wait_timeout=0.01, poll_interval=0.001)
+        handler = make_handler([], asyncio.Event())
+
+        original = asyncio.create_task(first.idempotent(handler)(name="a", idempotency_key="k"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as waited:
+            await second.idempotent(handler)(name="a", idempotency_key="k")
+        assert waited.value.status_code == 409
+
+        # Cancelling the original releases its claim
+        original.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await original
+        assert await collection.find_one({"key": "create_thing:k"}) is None
+
+    asyncio.run(scenario())
+
+
+def test_reused_key_with_a_different_request_is_rejected():
+    async def scenario():
+        collection = FakeCollection(unique=("key",))
+        handler = make_handler([])
+        await IdempotencyCache(collection).idempotent(handler)(name="a", idempotency_key="k")
+
+        with pytest.raises(HTTPException) as mismatch:
+            await IdempotencyCache(collection).idempotent(handler)(name="b", idempotency_key="k")
+        assert mismatch.value.status_code == 422
+
+    asyncio.run(scenario())
+
+
+def test_retry_takes_over_a_claim_whose_lease_ran_out():
+    async def scenario():
+        collection = FakeCollection(unique=("key",))
+        cache = IdempotencyCache(collection, lease_seconds=30)
+        calls = []
+        # Left behind by a process that crashed an hour ago while running the handler
+        fingerprint = IdempotencyCache.fingerprint({"name": "a"})
+        claimed_at = datetime.utcnow() - timedelta(hours=1)
+        await collection.insert_one({
+            "key": "create_thing:k", "fingerprint": fingerprint, "claim": "dead",
+            "claimed_at": claimed_at, "created_at": claimed_at,
+        })
+
+        assert await cache.idempotent(make_handler(calls))(name="a", idempotency_key="k") == {"id": 1, "name": "a"}
+        assert calls == ["a"]
+        stored = await collection.find_one({"key": "create_thing:k"})
+        assert stored["response"] == {"id": 1, "name": "a"}
+
+    asyncio.run(scenario())
+
+
+def test_waiter_runs_the_handler_itself_when_the_original_is_cancelled():
+    async def scenario():
+        cache = IdempotencyCache(FakeCollection(unique=("key",)))
+        calls = []
+        gate = asyncio.Event()
+        handler = cache.idempotent(make_handler(calls, gate))
+
+        original = asyncio.create_task(handler(name="a", idempotency_key="k"))
+        await asyncio.sleep(0)
+        retry = asyncio.create_task(handler(name="a", idempotency_key="k"))
+        await asyncio.sleep(0)
+        original.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await original
+
+        gate.set()
+        assert await retry == {"id": 2, "name": "a"}
+        assert calls == ["a", "a"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+from scheduling import AgingPolicy, PolicyQueue, StrictPriorityPolicy, WeightedFairPolicy
+from simulate_queue import simulate
+
+
+def drain(queue):
+    order = []
+    while queue:
+        order.append(queue.pop())
+    return order
+
+
+def dispatches_until_health(policy, limit=50):
+    # One health entry, and a fresh emergency arrives after every dispatch
+    queue = PolicyQueue(policy)
+    queue.push("health", "health", 0.0)
+    for step in range(10):
+        queue.push("emergency", "emergency", float(step))
+    for dispatch in range(1, limit + 1):
+        if queue.pop() == "health":
+            return dispatch
+        queue.push("emergency", "emergency", float(10 + dispatch))
+    return None
+
+
+def test_strict_priority_orders_by_level_then_arrival():
+    queue = PolicyQueue(StrictPriorityPolicy())
+    queue.push("health", "health", 0.0)
+    queue.push("work-late", "work", 20.0)
+    queue.push("work-early", "work", 10.0)
+    queue.push("emergency", "emergency", 30.0)
+    assert drain(queue) == ["emergency", "work-early", "work-late", "health"]
+
+
+def test_aging_lets_long_waiting_health_overtake_fresh_emergency():
+    policy = AgingPolicy(600)
+    waited = policy.admit("health", 0.0)
+    assert waited < policy.admit("emergency", 1201.0)
+    assert waited > policy.admit("emergency", 1199.0)
+
+
+def test_weighted_fair_serves_health_within_bounded_dispatches():
+    # With weights 6:3:1, health gets a turn after at most six emergencies
+    served_at = dispatches_until_health(WeightedFairPolicy())
+    assert served_at is not None
+    assert served_at <= 7
+
+
+def test_weighted_fair_bound_holds_after_abandoned_joins():
+    # Joining and leaving before being served must not push later entries back
+    policy = WeightedFairPolicy()
+    for _ in range(5):
+        policy.withdrawn("health", policy.admit("health", 0.0))
+    served_at = dispatches_until_health(policy)
+    assert served_at is not None
+    assert served_at <= 7
+
+
+def test_strict_priority_starves_health_under_sustained_emergencies():
+    assert dispatches_until_health(StrictPriorityPolicy()) is None
+
+
+def test_weighted_fair_state_round_trips():
+    policy = WeightedFairPolicy()
+    keys = [policy.admit("work", 0.0), policy.admit("work", 0.0)]
+    policy.dispatched(keys[0])
+
+    restored = WeightedFairPolicy()
+    restored.load_state(policy.state())
+    assert restored.admit("work", 0.0) == policy.admit("work", 0.0)
+
+
+def test_simulation_bounds_health_wait_with_aging():
+    # An emergency every 60s, each taking 60s, keeps the bathroom busy for an hour
+    arrivals = [{"priority": "health", "arrived_at": 0.0, "service": 60.0}]
+    arrivals += [{"priority": "emergency", "arrived_at": 60.0 * i, "service": 60.0} for i in range(60)]
+
+    def health_wait(policy):
+        return next(w["wait"] for w in simulate(arrivals, policy) if w["priority"] == "health")
+
+    assert health_wait(StrictPriorityPolicy()) >= 3600
+    assert health_wait(AgingPolicy(600)) <= 1260
@@ -0,0 +1,95 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+from bson.binary import Binary
+
+from migrate_compact_storage import migrate_collection
+from server import HygieneRating, PriorityLevel, QueueItem, QueueStatus, UserColor
+from storage import hygiene_rating_storage, queue_storage
+from tests.fakes import FakeCollection
+
+
+def queue_item(**overrides):
+    fields = {
+        "user_id": str(uuid.uuid4()),
+        "user_name": "Alex",
+        "user_color": UserColor.CYAN,
+        "priority": PriorityLevel.HEALTH,
+        "status": QueueStatus.WAITING,
+        "created_at": datetime(2024, 1, 1, 8, 30),
+    }
+    return QueueItem(**{**fields, **overrides})
+
+
+def test_queue_item_round_trips_through_compact_storage():
+    codec = queue_storage(True)
+    item = queue_item()
+    stored = codec.encode(item.dict())
+
+    assert stored["_id"] == Binary.from_uuid(uuid.UUID(item.id))
+    assert stored["u"] == Binary.from_uuid(uuid.UUID(item.user_id))
+    assert (stored["p"], stored["s"], stored["c"]) == (2, 0, 7)
+    # Unset optional fields are left out rather than stored as null
+    assert not {"r", "ts", "tc"} & set(stored)
+    assert QueueItem(**codec.decode(stored)) == item
+
+
+def test_hygiene_rating_round_trips_through_compact_storage():
+    codec = hygiene_rating_storage(True)
+    rating = HygieneRating(rated_by_user_id=str(uuid.uuid4()), rated_by_name="Sam", rating=4)
+    stored = codec.encode(rating.dict())
+
+    assert stored["_id"] == Binary.from_uuid(uuid.UUID(rating.id))
+    assert stored["u"] == Binary.from_uuid(uuid.UUID(rating.rated_by_user_id))
+    assert "m" not in stored
+    assert HygieneRating(**codec.decode(stored)) == rating
+
+
+def test_plain_storage_leaves_documents_alone():
+    codec = queue_storage(False)
+    doc = queue_item().dict()
+    assert codec.encode(doc) is doc
+    assert codec.query({"status": {"$in": ["waiting"]}}) == {"status": {"$in": ["waiting"]}}
+
+
+def test_query_translates_operators_and_dotted_fields():
+    codec = queue_storage(True)
+    user_id = str(uuid.uuid4())
+
+    assert codec.query({"status": {"$in": [QueueStatus.WAITING, QueueStatus.USING]}}) == {"s": {"$in": [0, 1]}}
+    assert codec.query({"user_id": user_id}) == {"u": Binary.from_uuid(uuid.UUID(user_id))}
+    assert codec.query({
+        "$or": [{"schedule_keys.fair": {"$exists": False}}, {"priority": "emergency"}]
+    }) == {"$or": [{"k.fair": {"$exists": False}}, {"p": 0}]}
+    assert codec.query({"status": "waiting", "schedule_keys.aging": {"$gt": 5.0}}) == {"s": 0, "k.aging": {"$gt": 5.0}}
+
+
+def test_migration_forward_then_reverse_restores_documents():
+    async def scenario():
+        originals = [
+            queue_item(reason="shower", started_at=datetime(2024, 1, 1, 9)).dict(),
+            queue_item(priority=PriorityLevel.EMERGENCY, status=QueueStatus.COMPLETED).dict(),
+        ]
+        collection = FakeCollection()
+        for doc in originals:
+            await collection.insert_one(dict(doc))
+        codec = queue_storage(True)
+
+        assert await migrate_collection(collection, codec, reverse=False) == 2
+        assert all(isinstance(doc["_id"], Binary) and "id" not in doc for doc in collection.docs)
+        # A rerun finds nothing left to convert
+        assert await migrate_collection(collection, codec, reverse=False) == 0
+
+        assert await migrate_collection(collection, codec, reverse=True) == 2
+        restored = sorted(
+            ({name: value for name, value in doc.items() if name != "_id"} for doc in collection.docs),
+            key=lambda doc: doc["id"]
+        )
+        expected = sorted(
+            ({name: value for name, value in doc.items() if value is not None} for doc in originals),
+            key=lambda doc: doc["id"]
+        )
+        assert restored == expected
+
+    asyncio.run(scenario())